@@ -1,13 +1,17 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.express as px
-import json, re, os
+import plotly.io as pio
+import plotly.graph_objects as go
+import json, re, os, io, hashlib
 from openai import OpenAI
-from bi_utils import apply_filters, calc_kpi, format_val
+from bi_utils import apply_filters, calc_kpis, format_val, parse_expr, lttb_indices
 
 # --- CONFIG ---
 st.set_page_config(page_title="Auto-BI Smart Studio", layout="wide")
 st.title("🧠 Auto-BI — Smart Dashboard Generator")
+pio.templates["autobi"] = go.layout.Template(layout=dict(height=400, margin=dict(l=10, r=10, t=40, b=30)))
 
 # --- API KEY ---
 OPENAI_API_KEY = st.secrets.get("OPENAI_API_KEY", os.getenv("OPENAI_API_KEY"))
@@ -17,20 +21,63 @@ if not OPENAI_API_KEY:
 client = OpenAI(api_key=OPENAI_API_KEY)
 
 # --- STATE ---
-for k,v in {"df":None,"spec":None,"filters":{},"mode":"Edit","theme":"Light"}.items():
+for k,v in {"df":None,"df_key":None,"spec":None,"spec_view":None,"filters":{},"figs":{},"export_kpis":[],"export_ids":[],"mode":"Edit","theme":"Light"}.items():
     if k not in st.session_state: st.session_state[k]=v
 
+# --- HELPER: decode the first JSON object in model output ---
+_DECODER = json.JSONDecoder()
+_TRAILING_COMMA_RE = re.compile(r",(\s*[}\]])")
+
+def parse_spec(text):
+    try:
+        return _DECODER.raw_decode(text, max(text.find("{"), 0))[0]
+    except json.JSONDecodeError:
+        text = _TRAILING_COMMA_RE.sub(r"\1", text)
+        return _DECODER.raw_decode(text, max(text.find("{"), 0))[0]
+
+# --- HELPER: render view of a spec without elements on unknown columns (run once per spec/file) ---
+def validate_spec(spec, columns):
+    cols = set(columns)
+    kpis = [{**k, "_parsed": parse_expr(k.get("expr"))} for k in spec.get("kpis", [])]
+    return {**spec,
+            "filters": [f for f in spec.get("filters", []) if f.get("field") in cols],
+            "charts": [c for c in spec.get("charts", []) if c.get("x") in cols and c.get("y") in cols],
+            "kpis": [k for k in kpis if k["_parsed"][1] in cols]}
+
+# --- HELPER: cached Excel load (keyed on file bytes) ---
+@st.cache_data(max_entries=4, ttl=3600, show_spinner=False)
+def load_excel(data):
+    df = pd.read_excel(io.BytesIO(data), engine="calamine")
+    for col in df.select_dtypes(include=["object", "string"]):
+        if df[col].nunique() < 0.5 * len(df):
+            df[col] = df[col].astype("category")
+    for col in df.select_dtypes(include="integer"):
+        df[col] = pd.to_numeric(df[col], downcast="integer")
+    return df
+
+# --- HELPER: cached filter options (keyed on uploaded file) ---
+@st.cache_data(max_entries=256, show_spinner=False)
+def filter_values(df_key, _df, field):
+    s = _df[field]
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        return sorted(s.cat.categories.astype(str).unique())
+    return sorted(s.dropna().astype(str).unique())
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def filter_has_nulls(df_key, _df, field):
+    return bool(_df[field].hasnans)
+
+# --- HELPER: cached chart aggregation (keyed on file + filter state) ---
+@st.cache_data(max_entries=256, show_spinner=False)
+def agg_sum(view_key, _df, x, y):
+    g = _df.groupby(x, observed=True)[y]
+    return (g.sum() if pd.api.types.is_numeric_dtype(_df[y]) else g.count()).reset_index()
+
 # --- HELPER: detect column types ---
 def detect_column_roles(df):
-    roles = {}
-    for c in df.columns:
-        if pd.api.types.is_numeric_dtype(df[c]):
-            roles[c] = "numeric"
-        elif pd.api.types.is_datetime64_any_dtype(df[c]):
-            roles[c] = "date"
-        else:
-            roles[c] = "categorical"
-    return roles
+    kinds = np.array([d.kind for d in df.dtypes], dtype="U1")
+    roles = np.select([np.isin(kinds, list("iufcb")), kinds == "M"], ["numeric", "date"], "categorical")
+    return dict(zip(df.columns, roles.tolist()))
 
 # --- HELPER: choose best chart type ---
 def suggest_chart_type(x_type, y_type):
@@ -46,6 +93,94 @@ def suggest_chart_type(x_type, y_type):
         return "histogram"
     return "bar"
 
+# --- HELPER: downsample tall line/scatter data (LTTB) ---
+MAX_POINTS = 2000
+
+def downsample(frame, x, y):
+    if len(frame) <= MAX_POINTS: return frame
+    pts = frame[list(dict.fromkeys((x, y)))].dropna().sort_values(x)
+    return pts.iloc[lttb_indices(pts[x], pts[y], MAX_POINTS)]
+
+# --- HELPER: build a chart once, then refresh only its trace data ---
+def make_figure(typ, d, df_f, x, y, theme):
+    kw = dict(template=("plotly_dark" if theme == "Dark" else "plotly_white") + "+autobi",
+              title=f"{x} vs {y} ({typ.capitalize()})")
+    if typ == "line": return px.line(d, x=x, y=y, **kw)
+    if typ == "pie": return px.pie(d, names=x, values=y, **kw)
+    if typ == "scatter": return px.scatter(df_f, x=x, y=y, **kw)
+    if typ == "histogram": return px.histogram(df_f, x=y, **kw)
+    return px.bar(d, x=x, y=y, **kw)
+
+def update_figure(fig, typ, d, df_f, x, y):
+    tr = fig.data[0]
+    if typ == "pie": tr.labels, tr.values = d[x].to_numpy(), d[y].to_numpy()
+    elif typ == "scatter": tr.x, tr.y = df_f[x].to_numpy(), df_f[y].to_numpy()
+    elif typ == "histogram": tr.x = df_f[y].to_numpy()
+    else: tr.x, tr.y = d[x].to_numpy(), d[y].to_numpy()
+
+# --- HELPER: assemble export HTML only when requested ---
+def build_export_html():
+    parts = ["<html><body style='font-family:sans-serif;'>"]
+    parts += [f"<h4>{t}</h4><p>{v}</p>" for t, v in st.session_state.export_kpis]
+    for i, cid in enumerate(st.session_state.export_ids):
+        fig = st.session_state.figs[cid]
+        parts.append(fig.to_html(full_html=False, include_plotlyjs="cdn" if i == 0 else False))
+    parts.append("</body></html>")
+    return "".join(parts)
+
+# --- HELPER: streamed chat completion (only the parsed spec is cached, via _chat) ---
+MODEL = "gpt-4o-mini"
+
+def _stream_chat(query, model, temperature):
+    stream = client.chat.completions.create(
+        model=model,
+        messages=[{"role":"user","content":query}],
+        temperature=temperature,
+        stream=True
+    )
+    box, txt = st.sidebar.empty(), ""
+    for i, chunk in enumerate(stream):
+        if chunk.choices:
+            txt += chunk.choices[0].delta.content or ""
+        if i % 10 == 0:
+            box.code(txt, language="json")
+    box.empty()
+    return txt
+
+# store-only cache: a lookup miss raises (nothing stored), passing _spec fills the entry;
+# streaming stays outside so cache hits replay no sidebar elements
+@st.cache_data(ttl=3600, show_spinner=False)
+def _chat(query, model, temperature, _spec=None):
+    if _spec is None: raise LookupError(query)
+    return _spec
+
+# --- HELPER: build spec prompt ---
+MAX_PROMPT_COLS, MAX_PROMPT_CHARS = 30, 500
+
+def generate_spec(prompt, columns, fresh=False):
+    prompt, cols = prompt[:MAX_PROMPT_CHARS], [str(c) for c in columns]
+    scope = "Only use these columns.\n"
+    if len(cols) > MAX_PROMPT_COLS:
+        # wide sheet: columns named in the prompt go first so truncation keeps them
+        low = prompt.lower()
+        named = [c for c in cols if re.search(rf"(?<!\w){re.escape(c.lower())}(?!\w)", low)]
+        cols, scope = list(dict.fromkeys(named + cols))[:MAX_PROMPT_COLS], ""
+    query = f"""
+You are a BI analyst. Create a JSON dashboard spec for this prompt:
+'{prompt}'
+Columns: [{", ".join(cols)}]
+{scope}Use structure:
+{{"filters":[{{"field":""}}],"kpis":[{{"title":"","expr":"","format":""}}],"charts":[{{"x":"","y":""}}]}}
+Return valid JSON only.
+"""
+    args = (query, MODEL, 0.3)
+    if fresh:
+        _chat.clear(*args)
+    else:
+        try: return _chat(*args)
+        except LookupError: pass
+    return _chat(*args, _spec=parse_spec(_stream_chat(*args)))
+
 # --- SIDEBAR ---
 st.sidebar.header("⚙️ Controls")
 st.session_state.mode = st.sidebar.radio("Mode", ["Edit","Presentation"], index=0)
@@ -53,11 +188,18 @@ st.session_state.theme = st.sidebar.radio("Theme", ["Light","Dark"], index=0)
 
 file = st.sidebar.file_uploader("Upload Excel", type=["xlsx","xls"])
 if file:
-    st.session_state.df = pd.read_excel(file)
+    data = file.getvalue()
+    key = hashlib.md5(data).hexdigest()
+    if key != st.session_state.df_key:
+        st.session_state.df, st.session_state.df_key = load_excel(data), key
+        st.session_state.filters, st.session_state.figs = {}, {}
+        if st.session_state.spec:
+            st.session_state.spec_view = validate_spec(st.session_state.spec, st.session_state.df.columns)
 
 st.sidebar.divider()
 prompt = st.sidebar.text_area("💬 Dashboard prompt",
     placeholder="Example: Compare sales and profit across regions and quarters.")
+force = st.sidebar.checkbox("🔁 Force regenerate", value=False)
 
 # --- GENERATE SPEC USING PROMPT ---
 if st.sidebar.button("✨ Generate Dashboard") and prompt:
@@ -65,32 +207,19 @@ if st.sidebar.button("✨ Generate Dashboard") and prompt:
     if df is None:
         st.sidebar.warning("Upload data first.")
     else:
-        cols = ", ".join(df.columns)
-        query = f"""
-You are a BI analyst. Create a JSON dashboard spec for this prompt:
-'{prompt}'
-Columns: [{cols}]
-Use structure:
-{{"filters":[{{"field":""}}],"kpis":[{{"title":"","expr":"","format":""}}],"charts":[{{"x":"","y":""}}]}}
-Return valid JSON only.
-"""
-        r = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role":"user","content":query}],
-            temperature=0.3
-        )
-        txt = re.sub(r"```(json)?|```","",r.choices[0].message.content)
         try:
-            st.session_state.spec = json.loads(txt)
+            spec = generate_spec(prompt.strip(), df.columns, fresh=force)
+            st.session_state.spec_view = validate_spec(spec, df.columns)
+            st.session_state.spec = spec
+            st.session_state.figs = {}
             st.success("✅ Dashboard spec generated successfully!")
         except Exception:
             st.sidebar.error("Invalid JSON from model.")
 
 st.sidebar.divider()
 if st.sidebar.button("🧾 Export HTML") and st.session_state.get("spec"):
-    html = st.session_state.get("export_html","")
-    if html:
-        st.sidebar.download_button("Download HTML", data=html,
+    if st.session_state.export_kpis or st.session_state.export_ids:
+        st.sidebar.download_button("Download HTML", data=build_export_html(),
             file_name="dashboard.html", mime="text/html")
 
 # --- MAIN ---
@@ -99,83 +228,84 @@ if df is None:
     st.info("Upload a dataset and enter a dashboard prompt in the sidebar.")
     st.stop()
 
-spec = st.session_state.spec
+spec = st.session_state.spec_view
 if not spec:
     st.info("Enter a prompt and click 'Generate Dashboard'.")
     st.stop()
 
-filters = st.session_state.filters
-roles = detect_column_roles(df)
-
-# --- FILTERS ---
-if st.session_state.mode == "Edit" and spec.get("filters"):
-    st.markdown("### 🎛 Filters")
-    fcols = st.columns(min(3, len(spec["filters"])))
-    for i, fdef in enumerate(spec["filters"][:3]):
-        field = fdef.get("field")
-        if field in df.columns:
-            vals = sorted(df[field].dropna().astype(str).unique())
-            sel = fcols[i].multiselect(field, vals, default=filters.get(field, []))
-            filters[field] = sel
-df_f = apply_filters(df, filters)
-st.session_state.filters = filters
-
-# --- RENDER DASHBOARD ---
-html_out = "<html><body style='font-family:sans-serif;'>"
-
-# KPIs
-if spec.get("kpis"):
-    st.markdown("#### 📈 KPIs")
-    kpi_cols = st.columns(min(4, len(spec["kpis"])))
-    for i, k in enumerate(spec["kpis"]):
-        expr, fmt = k.get("expr"), k.get("format", "auto")
-        val = calc_kpi(df_f, expr)
-        kpi_cols[i % 4].metric(k.get("title", expr), format_val(val, fmt))
-        html_out += f"<h4>{k.get('title')}</h4><p>{format_val(val,fmt)}</p>"
-
-# CHARTS
-if spec.get("charts"):
-    st.markdown("#### 📊 Charts")
-    charts = spec["charts"]
-    ncols = 2 if len(charts) > 1 else 1
-    chart_rows = [charts[i:i+ncols] for i in range(0, len(charts), ncols)]
-
-    for row in chart_rows:
-        cols = st.columns(len(row))
-        for idx, chart_def in enumerate(row):
-            with cols[idx]:
-                x, y = chart_def.get("x"), chart_def.get("y")
-                if not x or not y or x not in df.columns or y not in df.columns:
-                    continue
-                x_type, y_type = roles.get(x, "categorical"), roles.get(y, "numeric")
-                typ = suggest_chart_type(x_type, y_type)
-
-                d = df_f.groupby(x)[y].sum().reset_index()
-
-                if typ == "bar":
-                    fig = px.bar(d, x=x, y=y)
-                elif typ == "line":
-                    fig = px.line(d, x=x, y=y)
-                elif typ == "pie":
-                    fig = px.pie(d, names=x, values=y)
-                elif typ == "scatter":
-                    fig = px.scatter(df_f, x=x, y=y)
-                elif typ == "histogram":
-                    fig = px.histogram(df_f, x=y)
-                else:
-                    fig = px.bar(d, x=x, y=y)
-
-                fig.update_layout(
-                    template="plotly_dark" if st.session_state.theme == "Dark" else "plotly_white",
-                    height=400,
-                    margin=dict(l=10, r=10, t=40, b=30),
-                    title=f"{x} vs {y} ({typ.capitalize()})"
-                )
-                st.plotly_chart(fig, use_container_width=True)
-                html_out += fig.to_html(include_plotlyjs="cdn")
-
-html_out += "</body></html>"
-st.session_state.export_html = html_out
+# --- DASHBOARD (fragment: filter changes rerun only this block) ---
+@st.fragment
+def dashboard_body(df, spec):
+    filters = st.session_state.filters
+    roles = detect_column_roles(df)
+
+    # FILTERS
+    if st.session_state.mode == "Edit" and spec.get("filters"):
+        st.markdown("### 🎛 Filters")
+        fcols = st.columns(min(3, len(spec["filters"])))
+        for i, fdef in enumerate(spec["filters"][:3]):
+            field = fdef["field"]
+            vals = filter_values(st.session_state.df_key, df, field)
+            sel = fcols[i].multiselect(field, vals, default=sorted(filters.get(field, ())))
+            filters[field] = frozenset(sel)
+    # a selection covering every option of a null-free column filters nothing, so skip its scan
+    df_key = st.session_state.df_key
+    active = {c: v for c, v in filters.items()
+              if v and c in df.columns and (filter_has_nulls(df_key, df, c)
+                                            or len(v) < len(filter_values(df_key, df, c)))}
+    df_f = apply_filters(df, active)
+    st.session_state.filters = filters
+    view_key = (st.session_state.df_key, tuple(sorted((c, tuple(sorted(v))) for c, v in active.items())))
+
+    # RENDER
+    export_kpis, export_ids = [], []
+
+    # KPIs
+    if spec.get("kpis"):
+        st.markdown("#### 📈 KPIs")
+        kpi_cols = st.columns(min(4, len(spec["kpis"])))
+        kpi_vals = calc_kpis(df_f, [k["_parsed"] for k in spec["kpis"]])
+        for i, (k, val) in enumerate(zip(spec["kpis"], kpi_vals)):
+            expr, fmt = k.get("expr"), k.get("format", "auto")
+            val_txt = format_val(val, fmt)
+            kpi_cols[i % 4].metric(k.get("title", expr), val_txt)
+            export_kpis.append((k.get('title'), val_txt))
+
+    # CHARTS
+    if spec.get("charts"):
+        st.markdown("#### 📊 Charts")
+        charts = spec["charts"]
+        ncols = 2 if len(charts) > 1 else 1
+        chart_rows = [charts[i:i+ncols] for i in range(0, len(charts), ncols)]
+
+        figs = st.session_state.figs
+        for ri, row in enumerate(chart_rows):
+            cols = st.columns(len(row))
+            for idx, chart_def in enumerate(row):
+                with cols[idx]:
+                    x, y = chart_def["x"], chart_def["y"]
+                    x_type, y_type = roles.get(x, "categorical"), roles.get(y, "numeric")
+                    typ = suggest_chart_type(x_type, y_type)
+
+                    d, raw = agg_sum(view_key, df_f, x, y), df_f
+                    if typ == "line": d = downsample(d, x, y)
+                    elif typ == "scatter": raw = downsample(df_f, x, y)
+
+                    theme = st.session_state.theme
+                    cid = f"chart_{ri * ncols + idx}_{x}_{y}_{typ}_{theme}"
+                    fig = figs.get(cid)
+                    if fig is None or not fig.data:
+                        fig = figs[cid] = make_figure(typ, d, raw, x, y, theme)
+                    else:
+                        update_figure(fig, typ, d, raw, x, y)
+                    st.plotly_chart(fig, use_container_width=True, key=cid)
+                    export_ids.append(cid)
+
+    st.session_state.export_kpis, st.session_state.export_ids = export_kpis, export_ids
+    # keep only figures drawn this pass; stale theme/chart-type variants would hold their data forever
+    st.session_state.figs = {cid: st.session_state.figs[cid] for cid in export_ids}
+
+dashboard_body(df, spec)
 
 # --- Presentation mode CSS ---
 if st.session_state.mode == "Presentation":
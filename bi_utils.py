@@ -1,23 +1,81 @@
+import re
+from functools import lru_cache
+import numpy as np
 import pandas as pd
 
+def _str_mask(s, vals):
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        hit = s.cat.categories.astype(str).isin(vals)
+        return np.append(hit, False)[s.cat.codes.to_numpy()]  # code -1 (NaN) -> False
+    if pd.api.types.is_numeric_dtype(s) and not pd.api.types.is_bool_dtype(s):
+        try:
+            return s.isin({float(v) for v in vals}).to_numpy(dtype=bool, na_value=False)
+        except ValueError:
+            pass
+    return s.astype(str).isin(vals).to_numpy()
+
 def apply_filters(df, filters):
+    mask, active = np.ones(len(df), dtype=bool), False
     for col, vals in filters.items():
         if col in df.columns and vals:
-            df = df[df[col].astype(str).isin(vals)]
-    return df
+            np.logical_and(mask, _str_mask(df[col], frozenset(vals)), out=mask)  # masks may be read-only
+            active = True
+    return df.iloc[mask] if active else df
+
+def lttb_indices(x, y, n_out):
+    # Largest-Triangle-Three-Buckets: keep the point per bucket that spans the largest
+    # triangle with the previously kept point and the next bucket's mean. x must be sorted.
+    n = len(x)
+    if n_out >= n or n_out < 3: return np.arange(n)
+    x = pd.Series(x)
+    xs = (x.astype("int64") if x.dtype.kind in "mM" else x).to_numpy(dtype=float)
+    ys = np.asarray(y, dtype=float)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    idx = np.empty(n_out, dtype=np.int64); idx[0], idx[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        nhi = edges[i + 2] if i + 2 < len(edges) else n
+        cx, cy = xs[hi:nhi].mean(), ys[hi:nhi].mean()
+        area = np.abs((xs[a] - cx) * (ys[lo:hi] - ys[a]) - (xs[a] - xs[lo:hi]) * (cy - ys[a]))
+        a = lo + int(area.argmax())
+        idx[i + 1] = a
+    return idx
+
+OPS = {"SUM": "sum", "AVG": "mean", "COUNT": "count", "MIN": "min", "MAX": "max"}
+FORMATTERS = {"pct": lambda v: f"{v*100:.2f}%", "currency": lambda v: f"₹{v:,.0f}"}
+_KPI_RE = re.compile(rf"^\s*({'|'.join(OPS)})\s*\((.*)\)$", re.IGNORECASE | re.DOTALL)
+
+@lru_cache(maxsize=256)
+def parse_expr(expr):
+    m = _KPI_RE.match(expr or "")
+    if not m: return None, None
+    return m.group(1).upper(), m.group(2)
 
 def calc_kpi(df, expr):
-    val = 0
+    op, col = expr if isinstance(expr, tuple) else parse_expr(expr)
+    if op is None or col not in df.columns: return 0
     try:
-        if expr.startswith("SUM("): col = expr[4:-1]; val = df[col].sum()
-        elif expr.startswith("AVG("): col = expr[4:-1]; val = df[col].mean()
-        elif expr.startswith("COUNT("): col = expr[6:-1]; val = df[col].count()
+        return getattr(df[col], OPS[op])()
     except Exception:
-        pass
-    return val
+        return 0
+
+def calc_kpis(df, parsed):
+    # Group KPIs by column so each column is reduced once per op: one sum/count also yields AVG.
+    by_col = {}
+    for op, col in parsed:
+        if op is not None and col in df.columns: by_col.setdefault(col, set()).add(op)
+    vals = {}
+    for col, ops in by_col.items():
+        shared = "AVG" in ops and pd.api.types.is_numeric_dtype(df[col])
+        need = (ops | {"SUM", "COUNT"}) - {"AVG"} if shared else ops
+        got = {op: calc_kpi(df, (op, col)) for op in need}
+        if shared: got["AVG"] = got["SUM"] / got["COUNT"] if got["COUNT"] else float("nan")
+        vals.update({(op, col): got[op] for op in ops})
+    return [vals.get(p, 0) for p in parsed]
 
 def format_val(v, fmt):
-    if fmt == "pct": return f"{v*100:.2f}%"
-    if fmt == "currency": return f"₹{v:,.0f}"
+    f = FORMATTERS.get(fmt)
+    if f: return f(v)
     if isinstance(v,float): return f"{v:,.0f}"
     return str(v)